@@ -1,7 +1,9 @@
 """Plotting utilities."""
+from collections import deque
 import seaborn as sns
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+from matplotlib.collections import LineCollection
 from scipy.spatial import ConvexHull, convex_hull_plot_2d
 from equadratures.datasets import score
 import numpy as np
@@ -646,12 +648,12 @@ def plot_decision_surface(PolyTree,ij,ax=None,X=None,y=None,max_depth=None,label
 
     # TODO - What to do in case where "data" doesn't exist? Have domain\subdomain attribute for each node?
     if X is None:
-            X = PolyTree.tree["data"][0]
+            X = PolyTree.tree.data[0]
     if y is None:
-            y = PolyTree.tree["data"][1]
+            y = PolyTree.tree.data[1]
     Xij = X[:,ij]
-    PolyTree.tree["Xmin"] = np.min(Xij,axis=0)
-    PolyTree.tree["Xmax"] = np.max(Xij,axis=0)
+    PolyTree.tree.Xmin = np.min(Xij,axis=0)
+    PolyTree.tree.Xmax = np.max(Xij,axis=0)
 
     if color.lower() == 'error':
             error = y - PolyTree.predict(X)
@@ -668,71 +670,62 @@ def plot_decision_surface(PolyTree,ij,ax=None,X=None,y=None,max_depth=None,label
     if colorbar:
         fig.colorbar(scat, orientation="vertical", pad=0.1, shrink=0.5,label=label)
 
-    def _get_boundaries(nodes,final):
-            # Find leaf nodes
-            left_children = [node["children"]["left"] for node in nodes]
-            leaf_nodes = np.array([True if node is None else False for node in left_children])
-
+    def _get_boundaries(nodes,queue,final):
             # Get splitting info from non-leaf nodes (i.e. split nodes)
-            split_nodes = nodes[~leaf_nodes]
-            split_dims = [node["j_feature"] for node in split_nodes]
-            split_vals = [node["threshold"] for node in split_nodes]
-            indices    = [node["index"]     for node in split_nodes]
+            split_nodes = [node for node in nodes if node.left is not None]
 
             # Labelling done before splits, as we only label up to max_depth and then return
             if label:
                     # If final, label all nodes, else only leaf nodes
-                    if final:
-                            for node in nodes:
-                                    ax.annotate('Node %d'%node["index"],(node["Xmax"][0],node["Xmax"][1]),
+                    for node in nodes:
+                            if final or node.left is None:
+                                    ax.annotate('Node %d'%node.index,(node.Xmax[0],node.Xmax[1]),
                                                 ha='right',va='top',textcoords='offset points',
                                                 xytext=(-5, -5))
+                    if final:
                             return
-                    else:
-                            for node in nodes[leaf_nodes]:
-                                    ax.annotate('Node %d'%node["index"],(node["Xmax"][0],node["Xmax"][1]),
-                                                ha='right',va='top',textcoords='offset points',
-                                                xytext=(-5, -5))
 
-            # Plot split lines
-            for n, node in enumerate(split_nodes):
-                    if split_dims[n]==ij[0]:
-                            ax.vlines(split_vals[n],node["Xmin"][1],
-                                       node["Xmax"][1],'k')
+            # Collect split lines, to be plotted once all levels are visited
+            for node in split_nodes:
+                    if node.j_feature==ij[0]:
+                            vsegs.append([(node.threshold,node.Xmin[1]),(node.threshold,node.Xmax[1])])
                     else:
-                            ax.hlines(split_vals[n],node["Xmin"][0],
-                                       node["Xmax"][0],'k')
+                            hsegs.append([(node.Xmin[0],node.threshold),(node.Xmax[0],node.threshold)])
 
-            # Update bounding boxes of child nodes before returning them
+            # Update bounding boxes of child nodes before queueing them
             for node in split_nodes:
-                    if node["j_feature"]==ij[0]:
-                            node["children"]["left"]["Xmax"]  = [node["threshold"],node["Xmax"][1]]
-                            node["children"]["right"]["Xmin"] = [node["threshold"],node["Xmin"][1]]
-                            node["children"]["left"]["Xmin"]  = node["Xmin"]
-                            node["children"]["right"]["Xmax"] = node["Xmax"]
+                    if node.j_feature==ij[0]:
+                            node.left.Xmax  = [node.threshold,node.Xmax[1]]
+                            node.right.Xmin = [node.threshold,node.Xmin[1]]
+                            node.left.Xmin  = node.Xmin
+                            node.right.Xmax = node.Xmax
                     else:
-                            node["children"]["left"]["Xmax"]  = [node["Xmax"][0],node["threshold"]]
-                            node["children"]["right"]["Xmin"] = [node["Xmin"][0],node["threshold"]]
-                            node["children"]["left"]["Xmin"]  = node["Xmin"]
-                            node["children"]["right"]["Xmax"] = node["Xmax"]
-
-            # Extract child node info for next level down
-            left_nodes  = [node["children"]["left"]  for node in split_nodes]
-            right_nodes = [node["children"]["right"] for node in split_nodes]
+                            node.left.Xmax  = [node.Xmax[0],node.threshold]
+                            node.right.Xmin = [node.Xmin[0],node.threshold]
+                            node.left.Xmin  = node.Xmin
+                            node.right.Xmax = node.Xmax
 
-            child_nodes = np.array(left_nodes + right_nodes)
+            # Queue child nodes for next level down
+            queue.extend(node.left  for node in split_nodes)
+            queue.extend(node.right for node in split_nodes)
 
-            return child_nodes
-
-    nodes = np.array([PolyTree.tree])
+    # Visit the tree level by level (breadth first)
+    queue = deque([PolyTree.tree])
     depth = 0
-    final = False
-    while len(nodes)>0:
-            if depth==max_depth: final = True
-            nodes = _get_boundaries(nodes,final)
+    vsegs, hsegs = [], []
+    while queue:
+            final = depth==max_depth
+            nodes = list(queue)
+            queue.clear()
+            _get_boundaries(nodes,queue,final)
             if final: break
             depth += 1
 
+    # Plot all the vertical, and all the horizontal, split lines as one collection each
+    for segs in (vsegs, hsegs):
+        if len(segs)>0:
+            ax.add_collection(LineCollection(segs, colors='k'))
+
     if show:
         plt.show()
     return fig, ax, scat
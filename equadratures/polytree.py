@@ -1,9 +1,55 @@
 import numpy as np
-from copy import deepcopy
+import os
+import io
+import gc
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from equadratures.parameter import Parameter
 from equadratures.poly import Poly
 from equadratures.basis import Basis
 from urllib.parse import quote
+try:
+    from numba import njit, prange, config, threading_layer
+    numba = True
+except ImportError as e:
+    numba = False
+
+class _Node(object):
+        """
+        Private class for a node of a PolyTree.
+
+        :param int index:
+                The index of the node in the tree.
+        :param float loss:
+                The loss of the node's polynomial on its training data.
+        :param Poly poly:
+                The polynomial fitted to the node's training data.
+        :param tuple data:
+                The training data (X, y) in the node.
+        :param int depth:
+                The depth of the node in the tree.
+        """
+        __slots__ = ('index', 'loss', 'poly', 'data', 'n_samples', 'j_feature', 'threshold', 'left', 'right', 'depth', 'flag',
+                     'test_loss', 'lower_loss', 'Xmin', 'Xmax', 'sorted_idx')
+
+        def __init__(self, index, loss, poly, data, depth):
+                self.index = index
+                self.loss = loss
+                self.poly = poly
+                self.data = data
+                self.n_samples = len(data[0])
+                self.j_feature = None
+                self.threshold = None
+                self.left = None
+                self.right = None
+                self.depth = depth
+                self.flag = False
+                self.test_loss = None
+                self.lower_loss = None
+                self.Xmin = None
+                self.Xmax = None
+                self.sorted_idx = None
 
 class PolyTree(object):
         """
@@ -20,15 +66,25 @@ class PolyTree(object):
         :param str basis:
                 The type of index set used for the basis. Options include: ``univariate``, ``total-order``, ``tensor-grid``, ``sparse-grid`` and ``hyperbolic-basis``
         :param str search:
-                The method of search to be used. Options are ``grid`` or ``exhaustive``.
+                The method of search to be used. Options are ``grid``, ``exhaustive`` or ``histogram``. ``histogram`` only searches the edges of (up to) ``max_bins`` equal-frequency bins of each dimension in a node (``loss_gradient`` only supports ``exhaustive`` and ``histogram``, and uses ``exhaustive`` for ``grid``).
         :param int samples:
                 The interval between splits if ``grid`` search is chosen.
+        :param int max_bins:
+                The maximum number of bins per dimension if ``histogram`` search is chosen.
+        :param numpy.dtype dtype:
+                The floating point type of the gradients used by the ``loss_gradient`` criterion. ``numpy.float32`` halves the memory traffic of the split search, at the cost of precision in the gains.
         :param bool verbose:
                 For debugging
         :param bool all_data:
                 Save data at all nodes (instead of only leaf nodes).
         :param list split_dims:
                 List of dimensions along which to make splits.
+        :param str layout:
+                The order in which the nodes are stored for traversal in ``predict`` and ``apply``. Options are ``bfs`` (breadth-first) or ``veb`` (van Emde Boas, a cache-oblivious layout which can be faster for deep trees).
+        :param bool incremental:
+                If ``True``, and ``poly_method`` is ``least-squares``, the ``model_aware`` criterion evaluates the (unweighted) least-squares loss of every candidate split from cumulative sums over the node's design matrix, and only fits polynomials to the chosen split. This is much faster, but can choose different splits to the default (``False``), which fits polynomials to both sides of every candidate split.
+        :param int n_jobs:
+                The number of threads used to search for the best split of a node over its features, and to split sibling subtrees near the root. ``-1`` uses all available cores.
 
         **Sample constructor initialisations**::
 
@@ -47,7 +103,7 @@ class PolyTree(object):
                 2. Broelemann, K., Kasneci, G., (2019) A Gradient-Based Split Criterion for Highly Accurate and Transparent Model Trees. In Int. Joint Conf. on Artificial Intelligence (IJCAI). 2030-2037. `Paper <https://www.ijcai.org/Proceedings/2019/0281.pdf>`__
                 3. Chan, T. F., Golub, G. H., LeVeque, R. J., (1983) Algorithms for computing the sample variance: Analysis and recommendations. The American Statistician. 37(3): 242–247. `Paper <https://www.tandfonline.com/doi/abs/10.1080/00031305.1983.10483115>`__
         """
-        def __init__(self, splitting_criterion='model_aware', max_depth=5, min_samples_leaf=None, order=1, basis='total-order', search='exhaustive', samples=50, verbose=False, poly_method="least-squares", poly_solver_args={},all_data=False,split_dims=None,k=0.05):
+        def __init__(self, splitting_criterion='model_aware', max_depth=5, min_samples_leaf=None, order=1, basis='total-order', search='exhaustive', samples=50, verbose=False, poly_method="least-squares", poly_solver_args={},all_data=False,split_dims=None,k=0.05,layout='bfs',incremental=False,n_jobs=1,max_bins=256,dtype=np.float64):
                 self.splitting_criterion = splitting_criterion
                 self.max_depth = max_depth
                 self.min_samples_leaf = min_samples_leaf
@@ -63,6 +119,13 @@ class PolyTree(object):
                 self.actual_max_depth = 0
                 self.all_data = all_data
                 self.k = k
+                self.layout = layout
+                self.incremental = incremental
+                self.n_jobs = n_jobs
+                self.max_bins = max_bins
+                self.dtype = dtype
+                self._poly_cache = {}
+                self._numba_serial = False
                 if split_dims is not None:
                         split_dims = [split_dims] if not isinstance(split_dims, list) else split_dims
                         assert all(isinstance(dim, int) for dim in split_dims), "split_dims should be a list if ints"
@@ -72,6 +135,10 @@ class PolyTree(object):
                 assert order > 0, "order must be a postive integer" 
                 assert samples > 0, "samples must be a postive integer"
                 assert k > 0, "k must be a positive number"
+                assert layout in ['bfs', 'veb'], "layout must be 'bfs' or 'veb'"
+                assert n_jobs == -1 or n_jobs > 0, "n_jobs must be a positive integer, or -1"
+                assert max_bins > 1, "max_bins must be an integer greater than 1"
+                assert np.dtype(dtype) in [np.float32, np.float64], "dtype must be numpy.float32 or numpy.float64"
 
         def get_splits(self):
                 """
@@ -83,26 +150,27 @@ class PolyTree(object):
                         **splits**: A list of Splits made in the format of a nested list: [[split, dimension], ...]
                 """
 
-                def _search_tree(node, splits):
-                        if node["children"]["left"] != None:
-                                if [node["threshold"], node["j_feature"]] not in splits:
-                                        splits.append([node["threshold"], node["j_feature"]])
-                                splits = _search_tree(node["children"]["left"], splits)
+                splits = []
+                seen = set()
+                stack = [self.tree]
+                while stack:
+                        node = stack.pop()
+                        if node.left != None or node.right != None:
+                                key = (node.threshold, node.j_feature)
+                                if key not in seen:
+                                        seen.add(key)
+                                        splits.append([*key])
 
-                        if node["children"]["right"] != None:
-                                if [node["threshold"], node["j_feature"]] not in splits:
-                                        splits.append([node["threshold"], node["j_feature"]])
-                                splits = _search_tree(node["children"]["right"], splits)
+                        if node.right != None:
+                                stack.append(node.right)
+                        if node.left != None:
+                                stack.append(node.left)
 
-                        return splits
-
-                return _search_tree(self.tree, [])
+                return splits
 
         def _split_data(self, j_feature, threshold, X, y):
-                idx_left = np.where(X[:, j_feature] <= threshold)[0]
-                idx_right = np.delete(np.arange(0, len(X)), idx_left)
-                assert len(idx_left) + len(idx_right) == len(X)
-                return (X[idx_left], y[idx_left]), (X[idx_right], y[idx_right])
+                mask = X[:, j_feature] <= threshold
+                return (X[mask], y[mask]), (X[~mask], y[~mask]), mask
 
         def get_polys(self):
                 """
@@ -114,19 +182,19 @@ class PolyTree(object):
                         **polys**: A list of Poly objects
                 """
 
-                def _search_tree(node, polys):
-                        if node["children"]["left"] == None and node["children"]["right"] == None:
-                                polys.append(node["poly"])
-
-                        if node["children"]["left"] != None:
-                                polys = _search_tree(node["children"]["left"], polys)
+                polys = []
+                stack = [self.tree]
+                while stack:
+                        node = stack.pop()
+                        if node.left == None and node.right == None:
+                                polys.append(node.poly)
 
-                        if node["children"]["right"] != None:
-                                polys = _search_tree(node["children"]["right"], polys)
+                        if node.right != None:
+                                stack.append(node.right)
+                        if node.left != None:
+                                stack.append(node.left)
 
-                        return polys
-
-                return _search_tree(self.tree, [])
+                return polys
 
         def fit(self, X, y):
                 """
@@ -146,10 +214,15 @@ class PolyTree(object):
 
                         def _splitter(node):
                                 # Extract data
-                                X, y = node["data"]
-                                depth = node["depth"]
+                                X, y = node.data
+                                depth = node.depth
                                 N, d = X.shape
 
+                                # Indices sorting each dimension of X (inherited from the parent node if available, and not needed at max depth)
+                                sort, node.sorted_idx = node.sorted_idx, None
+                                if sort is None and depth < self.max_depth:
+                                        sort = np.argsort(X, axis=0, kind='stable').astype(np.int32)
+
                                 # Dimensions to split along
                                 if self.split_dims is None:
                                     self.split_dims = range(d)
@@ -157,13 +230,15 @@ class PolyTree(object):
                                 # Find feature splits that might improve loss
                                 did_split = False
                                 if self.splitting_criterion == "model_aware":
-                                        loss_best = node["loss"]
+                                        loss_best = node.loss
                                 elif self.splitting_criterion == "model_agnostic" or self.splitting_criterion=="loss_gradient":
                                         loss_best = np.inf
                                 else:
                                         raise Exception("invalid splitting_criterion")
                                 data_best = None
+                                mask_best = None
                                 polys_best = None
+                                losses_best = None
                                 j_feature_best = None
                                 threshold_best = None
 
@@ -172,94 +247,164 @@ class PolyTree(object):
 
                                 # Perform threshold split search only if node has not hit max depth
                                 if (depth >= 0) and (depth < self.max_depth):
-                                        if self.splitting_criterion != "loss_gradient":
-
-                                                for j_feature in range(d):
-
-                                                        last_threshold = np.inf
+                                        if self.splitting_criterion == "model_aware":
+
+                                                # For least-squares polys, the residuals of all candidate splits can be computed from the node's
+                                                # design matrix (orthonormalised, and with y shifted by its mean for stability), without fitting polys
+                                                if self.incremental and self.poly_method == "least-squares":
+                                                        Q, _ = np.linalg.qr(self._get_poly(node.poly, X).T)
+                                                        y_shift = y - np.mean(y)
+
+                                                        # Splits must improve on the (unweighted) least-squares loss of the node itself
+                                                        r = y_shift - Q @ (Q.T @ y_shift)
+                                                        loss_best = float(r @ r) / N
+                                                else:
+                                                        Q = None
+
+                                                def _search_feature(j_feature):
+                                                        # Best split along j_feature (only if it improves on the node's own loss)
+                                                        loss_best_j = loss_best
+                                                        polys_best_j = None
+                                                        losses_best_j = None
+                                                        threshold_best_j = None
+                                                        polys_fit_j = 0
+
+                                                        # Sorted values along j_feature
+                                                        order = sort[:, j_feature]
+                                                        X_sorted = X[order, j_feature]
 
                                                         if self.search == 'exhaustive':
-                                                                threshold_search = X[:, j_feature]
+                                                                # Last occurrence of each unique value
+                                                                is_last = np.append(X_sorted[:-1] != X_sorted[1:], True)
+                                                                threshold_search = X_sorted[is_last]
+                                                                N_left_search = np.flatnonzero(is_last) + 1
                                                         elif self.search == 'grid':
                                                                 if self.samples > N:
                                                                         samples = N
                                                                 else:
                                                                         samples = self.samples
-                                                                threshold_search = np.linspace(np.min(X[:,j_feature]), np.max(X[:,j_feature]), num=samples)
+                                                                # Grid is already sorted, so only repeated values (from a zero-width range) need removing
+                                                                threshold_search = np.linspace(X_sorted[0], X_sorted[-1], num=samples)
+                                                                threshold_search = threshold_search[np.append(True, threshold_search[1:] > threshold_search[:-1])]
+                                                                N_left_search = np.searchsorted(X_sorted, threshold_search, side='right')
+                                                        elif self.search == 'histogram':
+                                                                threshold_search, N_left_search, unique = self._get_histogram_thresholds(X_sorted.reshape(-1,1))
+                                                                threshold_search = threshold_search[unique[:,0], 0]
+                                                                N_left_search = N_left_search[unique[:,0], 0]
                                                         else:
-                                                                raise Exception('Incorrect search type! Must be \'exhaustive\' or \'grid\'')
-
-                                                        # Perform threshold split search on j_feature
-                                                        for threshold in np.unique(np.sort(threshold_search)):
+                                                                raise Exception('Incorrect search type! Must be \'exhaustive\', \'grid\' or \'histogram\'')
+
+                                                        # Only search thresholds where both children have at least `min_samples_leaf` samples
+                                                        # (N_left_search is sorted, so these form a contiguous range)
+                                                        lo = np.searchsorted(N_left_search, self.min_samples_leaf, side='left')
+                                                        hi = np.searchsorted(N_left_search, N - self.min_samples_leaf, side='right')
+
+                                                        # Perform threshold split search on j_feature, using least-squares residuals from prefix sums
+                                                        if Q is not None:
+                                                                if hi > lo:
+                                                                        loss_split = self._get_partition_sse(Q[order], y_shift[order], N_left_search[lo:hi]) / N
+                                                                        i_best = np.argmin(loss_split)
+                                                                        if loss_split[i_best] < loss_best_j:
+                                                                                loss_best_j = loss_split[i_best]
+                                                                                threshold_best_j = threshold_search[lo:hi][i_best]
+                                                                return loss_best_j, j_feature, threshold_best_j, None, None, 0
+
+                                                        # Perform threshold split search on j_feature, fitting polys to each candidate split
+                                                        for threshold, N_left in zip(threshold_search[lo:hi], N_left_search[lo:hi]):
 
                                                                 # Split data based on threshold
-                                                                (X_left, y_left), (X_right, y_right) = self._split_data(j_feature, threshold, X, y)
-                                                                #print(j_feature, threshold, X_left, X_right)
-                                                                N_left, N_right = len(X_left), len(X_right)
-
-                                                                # Do not attempt to split if split conditions not satisfied
-                                                                if not (N_left >= self.min_samples_leaf and N_right >= self.min_samples_leaf):
-                                                                        continue
+                                                                N_right = N - N_left
+                                                                X_left, y_left = X[order[:N_left]], y[order[:N_left]]
+                                                                X_right, y_right = X[order[N_left:]], y[order[N_left:]]
 
                                                                 # Compute weight loss function
-                                                                if self.splitting_criterion == "model_aware":
-                                                                        loss_left, poly_left = _fit_poly(X_left, y_left)
-                                                                        loss_right, poly_right = _fit_poly(X_right, y_right)
+                                                                loss_left, poly_left = _fit_poly(X_left, y_left)
+                                                                loss_right, poly_right = _fit_poly(X_right, y_right)
 
-                                                                        loss_split = (N_left*loss_left + N_right*loss_right) / N
+                                                                loss_split = (N_left*loss_left + N_right*loss_right) / N
 
-                                                                        if self.verbose: polys_fit += 2
-
-                                                                elif self.splitting_criterion == "model_agnostic":
-                                                                        loss_split = np.std(y) - (N_left*np.std(y_left) + N_right*np.std(y_right)) / N
+                                                                polys_fit_j += 2
 
                                                                 # Update best parameters if loss is lower
-                                                                if loss_split < loss_best:
-                                                                        did_split = True
-                                                                        loss_best = loss_split
-                                                                        if self.splitting_criterion == "model_aware": polys_best = [poly_left, poly_right]
-                                                                        data_best = [(X_left, y_left), (X_right, y_right)]
-                                                                        j_feature_best = j_feature
-                                                                        threshold_best = threshold
+                                                                if loss_split < loss_best_j:
+                                                                        loss_best_j = loss_split
+                                                                        polys_best_j = [poly_left, poly_right]
+                                                                        losses_best_j = [loss_left, loss_right]
+                                                                        threshold_best_j = threshold
+
+                                                        return loss_best_j, j_feature, threshold_best_j, polys_best_j, losses_best_j, polys_fit_j
+
+                                                # Search each feature independently (in parallel if n_jobs != 1)
+                                                if executor is None:
+                                                        results = map(_search_feature, range(d))
+                                                else:
+                                                        results = executor.map(_search_feature, range(d))
+
+                                                # Take the best split over all features (the first feature wins a tie, as in a serial search)
+                                                for loss_split, j_feature, threshold, polys, losses, polys_fit_j in results:
+                                                        if self.verbose: polys_fit += polys_fit_j
+                                                        if loss_split < loss_best:
+                                                                did_split = True
+                                                                loss_best = loss_split
+                                                                polys_best = polys
+                                                                losses_best = losses
+                                                                j_feature_best = j_feature
+                                                                threshold_best = threshold
+
+                                        # Standard deviation based splitting criterion from ref. [1]
+                                        elif self.splitting_criterion == "model_agnostic":
+                                                did_split, j_feature_best, threshold_best = self._find_split_from_std(X, y, sort)
 
                                         # Gradient based splitting criterion from ref. [2]
                                         else:
-                                                # Fit a single poly to parent node
-                                                loss, poly = _fit_poly(X, y)
-
-                                                # Now run the splitting algo using gradients from this poly
-                                                did_split, j_feature_best, threshold_best = self._find_split_from_grad(poly, X, y.reshape(-1,1))
-
-                                # If model_agnostic or gradient based, fit poly's to children now we have split
-                                if self.splitting_criterion != "model_aware" and did_split:
-                                        (X_left, y_left), (X_right, y_right) = self._split_data(j_feature_best, threshold_best, X, y)
-                                        loss_left, poly_left = _fit_poly(X_left, y_left)
-                                        loss_right, poly_right = _fit_poly(X_right, y_right)
+                                                # Run the splitting algo using gradients from the poly already fitted to the parent node
+                                                did_split, j_feature_best, threshold_best = self._find_split_from_grad(node.poly, X, y.reshape(-1,1), sort)
+
+                                # Partition the data (and the sorting indices) of the chosen split
+                                if did_split:
+                                        (X_left, y_left), (X_right, y_right), mask_best = self._split_data(j_feature_best, threshold_best, X, y)
+                                        data_best = [(X_left, y_left), (X_right, y_right)]
+                                        if depth + 1 < self.max_depth:
+                                                sort_best = [self._partition_sort(sort, mask_best), self._partition_sort(sort, ~mask_best)]
+                                        else:
+                                                sort_best = [None, None]
+                                        del sort
+
+                                # If model_agnostic, gradient based or incremental, fit poly's to children now we have split
+                                # (keeping their polynomial terms only if the children will be split in turn)
+                                if did_split and polys_best is None:
+                                        cache = cache_poly and depth + 1 < self.max_depth
+                                        loss_left, poly_left = _fit_poly(X_left, y_left, cache)
+                                        loss_right, poly_right = _fit_poly(X_right, y_right, cache)
                                         N_left, N_right = len(X_left), len(X_right)
                                         loss_best = (N_left*loss_left + N_right*loss_right) / N
                                         polys_best = [poly_left, poly_right]
-                                        if self.splitting_criterion == "loss_gradient": data_best = [(X_left, y_left), (X_right, y_right)]
+                                        losses_best = [loss_left, loss_right]
 
                                         if self.verbose: polys_fit += 2
 
                                 if self.verbose and did_split: print("Node (X.shape = {}) fitted with {} polynomials generated".format(X.shape, polys_fit))
                                 elif self.verbose: print("Node (X.shape = {}) failed to fit after {} polynomials generated".format(X.shape, polys_fit))
 
-                                if did_split and depth > self.actual_max_depth:
-                                        self.actual_max_depth = depth
+                                if did_split:
+                                        with lock:
+                                                if depth > self.actual_max_depth:
+                                                        self.actual_max_depth = depth
 
                                 # Return the best result
                                 result = {"did_split": did_split,
                                                   "loss": loss_best,
                                                   "polys": polys_best,
+                                                  "losses": losses_best,
                                                   "data": data_best,
+                                                  "sorted_idx": sort_best if did_split else None,
                                                   "j_feature": j_feature_best,
                                                   "threshold": threshold_best,
                                                   "N": N}
 
                                 return result
 
-                        def _fit_poly(X, y):
+                        def _fit_poly(X, y, cache=False):
 
 #                                try:
 
@@ -275,16 +420,17 @@ class PolyTree(object):
                                                 myParameters.append(Parameter(distribution='Uniform', lower=values_min-0.01, upper=values_max+0.01, order=self.order))
                                         else:
                                                 myParameters.append(Parameter(distribution='Uniform', lower=values_min, upper=values_max, order=self.order))
-                                if self.basis == "hyperbolic-basis":
-                                        myBasis = Basis(self.basis, orders=[self.order for _ in range(d)], q=0.5)
-                                else:
-                                        myBasis = Basis(self.basis, orders=[self.order for _ in range(d)])
 
-                                container["index_node_global"] += 1
-                                poly = Poly(myParameters, myBasis, method=self.poly_method, sampling_args={'sample-points':X, 'sample-outputs':y}, solver_args=self.poly_solver_args)
+                                # Basis is shared by all nodes (Poly takes its own copy)
+                                poly = Poly(myParameters, self._basis_obj, method=self.poly_method, sampling_args={'sample-points':X, 'sample-outputs':y}, solver_args=self.poly_solver_args)
                                 poly.set_model()
 
-                                mse = np.linalg.norm(y - poly.get_polyfit(X).reshape(-1)) ** 2 / N
+                                # Evaluate the polynomial terms once, keeping them if the split search will need them (see _get_poly)
+                                P = poly.get_poly(X)
+                                if cache:
+                                        self._poly_cache[self._get_poly_key(poly, X)] = P
+                                r = y - np.dot(P.T, poly.coefficients.reshape(-1, 1)).reshape(-1)
+                                mse = float(r @ r) / N
 #                                except Exception as e:
 #                                        print("Warning fitting of Poly failed:", e)
 #                                        print(d, values_min, values_max)
@@ -292,59 +438,81 @@ class PolyTree(object):
 
                                 return mse, poly
 
-                        def _create_node(X, y, depth, container):
-                                poly_loss, poly = _fit_poly(X, y)
-
-                                node = {"name": "node",
-                                                "index": container["index_node_global"],
-                                                "loss": poly_loss,
-                                                "poly": poly,
-                                                "data": (X, y),
-                                                "n_samples": len(X),
-                                                "j_feature": None,
-                                                "threshold": None,
-                                                "children": {"left": None, "right": None},
-                                                "depth": depth,
-                                                "flag": False}
-                                container["index_node_global"] += 1
+                        def _create_node(X, y, depth, container, poly_loss=None, poly=None):
+                                # Only fit a poly if one has not already been fitted to this data (during the parent's split search)
+                                if poly is None:
+                                        poly_loss, poly = _fit_poly(X, y, cache_poly and depth < self.max_depth)
+
+                                node = _Node(next(container["index_node_global"]), poly_loss, poly, (X, y), depth)
 
                                 return node
 
                         def _split_traverse_node(node, container):
 
-                                result = _splitter(node)
-                                if not result["did_split"]:
-                                        return
+                                # Depth-first traversal with an explicit stack (children are split left first). Near the root, left
+                                # subtrees are handed to the subtree pool, and the right subtree is split by this thread
+                                stack = [node]
+                                futures = []
+                                while stack:
+                                        node = stack.pop()
 
-                                node["j_feature"] = result["j_feature"]
-                                node["threshold"] = result["threshold"]
+                                        result = _splitter(node)
+                                        if not result["did_split"]:
+                                                continue
 
-                                if not self.all_data:
-                                    del node["data"]
+                                        node.j_feature = result["j_feature"]
+                                        node.threshold = result["threshold"]
 
-                                (X_left, y_left), (X_right, y_right) = result["data"]
-                                poly_left, poly_right = result["polys"]
+                                        if not self.all_data:
+                                            node.data = None
 
-                                node["children"]["left"] = _create_node(X_left, y_left, node["depth"]+1, container)
-                                node["children"]["right"] = _create_node(X_right, y_right, node["depth"]+1, container)
-                                node["children"]["left"]["poly"] = poly_left
-                                node["children"]["right"]["poly"] = poly_right
+                                        (X_left, y_left), (X_right, y_right) = result["data"]
+                                        poly_left, poly_right = result["polys"]
+                                        loss_left, loss_right = result["losses"]
+                                        sort_left, sort_right = result["sorted_idx"]
 
-                                # Split nodes
-                                _split_traverse_node(node["children"]["left"], container)
-                                _split_traverse_node(node["children"]["right"], container)
+                                        node.left = _create_node(X_left, y_left, node.depth+1, container, loss_left, poly_left)
+                                        node.right = _create_node(X_right, y_right, node.depth+1, container, loss_right, poly_right)
+                                        node.left.sorted_idx = sort_left
+                                        node.right.sorted_idx = sort_right
 
-                        container = {"index_node_global": 0}
+                                        # The children now hold the only references to their data, drop ours so it can be freed along with them
+                                        del result, X_left, y_left, X_right, y_right, sort_left, sort_right
+
+                                        # Split nodes
+                                        stack.append(node.right)
+                                        if subtree_executor is not None and node.depth < subtree_depth:
+                                                futures.append(subtree_executor.submit(_split_traverse_node, node.left, container))
+                                        else:
+                                                stack.append(node.left)
+
+                                for future in futures:
+                                        future.result()
+
+                        container = {"index_node_global": itertools.count()}
                         root = _create_node(X, y, 0, container)
                         _split_traverse_node(root, container)
 
+                        # Subtrees split in parallel number their nodes in the order they are created, so renumber them as in a serial build
+                        if subtree_executor is not None:
+                                index = itertools.count(1)
+                                stack = [root]
+                                while stack:
+                                        node = stack.pop()
+                                        if node.left is not None:
+                                                node.left.index = next(index)
+                                                node.right.index = next(index)
+                                                stack.append(node.right)
+                                                stack.append(node.left)
+
                         return root
 
                 N, d = X.shape
                 if self.basis == "hyperbolic-basis":
-                        self.cardinality = Basis(self.basis, orders=[self.order for _ in range(d)], q=0.5).get_cardinality()
+                        self._basis_obj = Basis(self.basis, orders=[self.order]*d, q=0.5)
                 else:
-                        self.cardinality = Basis(self.basis, orders=[self.order for _ in range(d)]).get_cardinality()
+                        self._basis_obj = Basis(self.basis, orders=[self.order]*d)
+                self.cardinality = self._basis_obj.get_cardinality()
                 if self.min_samples_leaf == None or self.min_samples_leaf == self.cardinality:
                         self.min_samples_leaf = int(np.ceil(self.cardinality * 1.25))
                 elif self.cardinality > self.min_samples_leaf:
@@ -352,7 +520,32 @@ class PolyTree(object):
 
                 self.k *= self.min_samples_leaf
 
-                self.tree = _build_tree()
+                # The polynomial terms of fitted nodes are reused by the loss_gradient and incremental model_aware split searches
+                cache_poly = self.splitting_criterion == "loss_gradient" or (self.splitting_criterion == "model_aware" and self.incremental and self.poly_method == "least-squares")
+                self._poly_cache = {}
+
+                # Thread pools used to search features, and to split sibling subtrees, in parallel. Subtrees are only
+                # handed out above depth log2(n_jobs) (so at most n_jobs subtrees are split at once)
+                lock = threading.Lock()
+
+                # Compiled split searches are run serially if they may be run from several threads at once (see _is_workqueue)
+                self._numba_serial = numba and (self.n_jobs != 1 or _is_workqueue())
+                if self.n_jobs == 1:
+                        executor = None
+                        subtree_executor = None
+                        self.tree = _build_tree()
+                else:
+                        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+                        subtree_depth = int(np.log2(n_jobs))
+                        with ThreadPoolExecutor(max_workers=n_jobs) as executor, ThreadPoolExecutor(max_workers=max(2**subtree_depth - 1, 1)) as subtree_executor:
+                                self.tree = _build_tree()
+
+                # Release the temporary arrays from the build in one go (collecting only the younger generations, as a full
+                # collection of a large interpreter heap can take longer than fitting a small tree)
+                self._poly_cache = {}
+                gc.collect(1)
+
+                self._flatten_tree()
 
         def prune(self, X, y, tol=0.0):
                 """
@@ -371,37 +564,40 @@ class PolyTree(object):
                 def pruner(node, X_subset, y_subset):
 
                         if X_subset.shape[0] < 1:
-                                node["test_loss"] = 0
-                                node["n_samples"] = 0
+                                node.test_loss = 0
+                                node.n_samples = 0
                                 return node
 
-                        node["test_loss"] = np.linalg.norm(y_subset - node["poly"].get_polyfit(X_subset).reshape(-1)) ** 2 / X_subset.shape[0]
+                        r = y_subset - node.poly.get_polyfit(X_subset).reshape(-1)
+                        node.test_loss = float(r @ r) / X_subset.shape[0]
 
-                        is_left = node["children"]["left"] != None
-                        is_right = node["children"]["right"] != None
+                        is_left = node.left != None
+                        is_right = node.right != None
 
                         if is_left and is_right:
-                                (X_left, y_left), (X_right, y_right) = self._split_data(node["j_feature"], node["threshold"], X_subset, y_subset)
+                                (X_left, y_left), (X_right, y_right), _ = self._split_data(node.j_feature, node.threshold, X_subset, y_subset)
 
-                                node["children"]["left"] = pruner(node["children"]["left"], X_left, y_left)
-                                node["children"]["right"] = pruner(node["children"]["right"], X_right, y_right)
+                                node.left = pruner(node.left, X_left, y_left)
+                                node.right = pruner(node.right, X_right, y_right)
 
-                                lower_loss = ( node["children"]["left"]["test_loss"] * node["children"]["left"]["n_samples"] + node["children"]["right"]["test_loss"] * node["children"]["right"]["n_samples"] ) / ( node["children"]["left"]["n_samples"] + node["children"]["right"]["n_samples"] )
+                                lower_loss = ( node.left.test_loss * node.left.n_samples + node.right.test_loss * node.right.n_samples ) / ( node.left.n_samples + node.right.n_samples )
 
-                                node["lower_loss"] = lower_loss
+                                node.lower_loss = lower_loss
 
-                                if lower_loss + (tol* node["test_loss"]) > node["test_loss"]:
-                                        if self.verbose: print("prune",lower_loss, node["test_loss"], node["children"]["left"]["test_loss"], node["children"]["left"]["n_samples"], node["children"]["right"]["test_loss"], node["children"]["right"]["n_samples"])
-                                        node["children"]["left"] = None
-                                        node["children"]["right"] = None
+                                if lower_loss + (tol* node.test_loss) > node.test_loss:
+                                        if self.verbose: print("prune",lower_loss, node.test_loss, node.left.test_loss, node.left.n_samples, node.right.test_loss, node.right.n_samples)
+                                        node.left = None
+                                        node.right = None
 
                         return node
 
                 assert self.tree is not None, "Run fit() before prune()"
-                (X_left, y_left), (X_right, y_right) = self._split_data(self.tree["j_feature"], self.tree["threshold"], X, y)
+                (X_left, y_left), (X_right, y_right), _ = self._split_data(self.tree.j_feature, self.tree.threshold, X, y)
 
-                self.tree["children"]["left"] = pruner(self.tree["children"]["left"], X_left, y_left)
-                self.tree["children"]["right"] = pruner(self.tree["children"]["right"], X_right, y_right)
+                self.tree.left = pruner(self.tree.left, X_left, y_left)
+                self.tree.right = pruner(self.tree.right, X_right, y_right)
+
+                self._flatten_tree()
 
 
         def predict(self, X):
@@ -413,46 +609,29 @@ class PolyTree(object):
                 A numpy.ndarray of shape (1, number_of_observations) corresponding to the polynomial approximation of the tree.
             """
 
-            def _predict(node, indexes):
-
-                y_pred[indexes, node["depth"], 0] = node["poly"].get_polyfit(X[indexes]).reshape(-1)
-                y_pred[indexes, node["depth"], 1] = np.full(fill_value=node["n_samples"], shape=len(indexes))
-
-                no_children = node["children"]["left"] is None and \
-                              node["children"]["right"] is None
-                if no_children: return
-
-                idx_left = np.where(X[indexes, node["j_feature"]] <= node["threshold"])[0]
-                idx_right = np.where(X[indexes, node["j_feature"]] > node["threshold"])[0]
-
-                _predict(node["children"]["left"], indexes[idx_left])
-                _predict(node["children"]["right"], indexes[idx_right])
-
             assert self.tree is not None
-            y_pred = np.empty(shape=(X.shape[0], self.actual_max_depth + 2, 2)) * np.nan
 
-            _predict(self.tree, np.arange(0, X.shape[0]))
+            # Walk all observations down the flattened tree together, recording the node reached at each depth
+            path = _traverse_tree(self._flat_feature, self._flat_threshold, self._flat_left, self._flat_right, X, self.actual_max_depth + 2)
+            deepest = self._flat_depth[path[:, -1]]
 
-            smoothed_y_pred = np.zeros(shape=(X.shape[0]))
+            # Node predictions and sample counts along each path, stored as separate contiguous arrays
+            pred = np.full((X.shape[0], self.actual_max_depth + 2), np.nan, dtype=np.float64)
+            n = np.zeros((X.shape[0], self.actual_max_depth + 2), dtype=np.float64)
+            on_path = np.arange(self.actual_max_depth + 2) <= deepest.reshape(-1,1)
+            n[on_path] = self._flat_n_samples[path[on_path]]
 
-            for y in range(0,X.shape[0]):
-                i = self.actual_max_depth + 1
+            # Evaluate the poly of each node (once, for all observations that need it) where its prediction is used by the smoothing
+            needed = _get_smoothing_mask(n, deepest)
+            for i in range(self.actual_max_depth + 2):
+                indexes = np.flatnonzero(needed[:, i])
+                indexes = indexes[np.argsort(path[indexes, i], kind='stable')]
+                nodes, starts = np.unique(path[indexes, i], return_index=True)
+                for k, indexes_k in zip(nodes, np.split(indexes, starts[1:])):
+                    pred[indexes_k, i] = self._flat_nodes[k].poly.get_polyfit(X[indexes_k]).reshape(-1)
 
-                while np.isnan(y_pred[y][i][0]) and i > 0:
-                    i-=1
-
-                smoothed_y = y_pred[y][i][0]
-
-                #print(y_pred[i])
-                while i > 0:
-                    n_i = y_pred[y][i][1]
-                    if n_i == 0: break
-                    #print(smoothed_y)
-                    smoothed_y = (smoothed_y * n_i + y_pred[y][i][0] * self.k) / (self.k + n_i)
-                    i-=1
-
-                #print("\n")
-                smoothed_y_pred[y] = smoothed_y
+            # Smooth the predictions, from the deepest node reached by each observation back up towards the root
+            smoothed_y_pred = _smooth(pred, n, deepest, self.k)
 
             return smoothed_y_pred
 
@@ -468,22 +647,71 @@ class PolyTree(object):
                 :return:
                 **inode**: A numpy.ndarray of shape (number_of_observations,1) corresponding to the node indexs for each observation in X.
                 """
-                def _apply(node, indexes):
-                        no_children = node["children"]["left"] is None and \
-                        node["children"]["right"] is None
-                        if no_children:
-                                inode[indexes] = node["index"]
-                                return
+                if X.ndim == 1: X = X.reshape(1,-1)
 
-                        idx_left = np.where(X[indexes, node["j_feature"]] <= node["threshold"])[0]
-                        idx_right = np.where(X[indexes, node["j_feature"]] > node["threshold"])[0]
-                        _apply(node["children"]["left"], indexes[idx_left])
-                        _apply(node["children"]["right"], indexes[idx_right])
+                # Walk all observations down the flattened tree together, until each reaches a leaf (leaf nodes point to themselves)
+                leaves = _apply_tree(self._flat_feature, self._flat_threshold, self._flat_left, self._flat_right, X)
 
-                if X.ndim == 1: X = X.reshape(1,-1)
-                inode = np.zeros(shape=X.shape[0],dtype=int)
-                _apply(self.tree, np.arange(0, X.shape[0]))
-                return inode
+                return self._flat_index[leaves]
+
+        def _flatten_tree(self):
+                """
+                Private method to store the tree structure in flat arrays, with the nodes numbered in breadth-first (or van Emde Boas) order. These are used
+                to walk many observations down the tree at once in predict() and apply(). Leaf nodes have themselves as their own children.
+
+                :param PolyTree self:
+                    An instance of the PolyTree class.
+                """
+                nodes = [self.tree]
+                left = []
+                right = []
+                i = 0
+                while i < len(nodes):
+                        node = nodes[i]
+                        if node.left is None and node.right is None:
+                                left.append(i)
+                                right.append(i)
+                        else:
+                                left.append(len(nodes))
+                                right.append(len(nodes) + 1)
+                                nodes += [node.left, node.right]
+                        i += 1
+
+                left = np.array(left)
+                right = np.array(right)
+
+                # Optionally reorder the nodes into a van Emde Boas layout: the top half of the tree is stored first, followed
+                # by each of the subtrees hanging below it, with the same layout applied recursively within every piece
+                if self.layout == 'veb':
+                        def _veb_order(k, height):
+                                if height == 1:
+                                        return [k]
+                                top = height // 2
+                                order = _veb_order(k, top)
+                                bottom = [k]
+                                for _ in range(top):
+                                        bottom = [c for b in bottom if left[b] != b for c in (left[b], right[b])]
+                                for b in bottom:
+                                        order += _veb_order(b, height - top)
+                                return order
+
+                        height = max(node.depth for node in nodes) + 1
+                        order = np.array(_veb_order(0, height))
+                        position = np.empty_like(order)
+                        position[order] = np.arange(len(order))
+                        nodes = [nodes[k] for k in order]
+                        left = position[left[order]]
+                        right = position[right[order]]
+
+                is_leaf = [left[i] == i for i in range(len(nodes))]
+                self._flat_nodes = nodes
+                self._flat_left = left
+                self._flat_right = right
+                self._flat_feature = np.array([0 if leaf else node.j_feature for node, leaf in zip(nodes, is_leaf)])
+                self._flat_threshold = np.array([np.inf if leaf else node.threshold for node, leaf in zip(nodes, is_leaf)], dtype=float)
+                self._flat_depth = np.array([node.depth for node in nodes])
+                self._flat_index = np.array([node.index for node in nodes])
+                self._flat_n_samples = np.array([node.n_samples for node in nodes])
 
         def get_graphviz(self, X=None, feature_names=None, file_name=None):
                 """
@@ -492,40 +720,48 @@ class PolyTree(object):
                 :param PolyTree self:
                     An instance of the PolyTree class.
                 :param numpy.ndarray X:
-                        An ndarray with shape (dimensions) containing an input vector for a given sample, to highlight in the tree (optional).
+                        An ndarray with shape (dimensions) containing an input vector for a given sample, or with shape (number_of_observations, dimensions) containing several samples, whose paths are highlighted in the tree (optional).
                 :param list feature_names:
                         A list of the names of the features used in the training data (optional).
                 :param string filename:
                         Filename to write graphviz data to (optional). If None (default) then rendered in-place.
                 """
-                from graphviz import Digraph
-                g = Digraph('g', node_attr={'shape': 'record', 'height': '.1'})
-
                 if feature_names is None:
-                    dim = self.tree["poly"].dimensions
+                    dim = self.tree.poly.dimensions
                     feature_names = ['x_%d'%i for i in range(dim)]
 
-                def _build_graphviz_recurse(node, parent_node_index=0, parent_depth=0, edge_label=""):
-
-                        # Empty node
-                        if node is None:
-                                return
-
-                        # Create node
-                        node_index = node["index"]
-                        if node["children"]["left"] is None and node["children"]["right"] is None:
+                # Flag the node paths to highlight later (walking all the samples down the flattened tree at once). Flags
+                # from previous calls are cleared first
+                for node in self._flat_nodes:
+                        node.flag = False
+                if X is not None:
+                        path = _traverse_tree(self._flat_feature, self._flat_threshold, self._flat_left, self._flat_right, np.atleast_2d(X), self.actual_max_depth + 2)
+                        for k in np.unique(path):
+                                self._flat_nodes[k].flag = True
+
+                # Build graph, writing the DOT source of each node (and the edge from its parent) directly. Nodes are
+                # visited depth first, left child before right, from an explicit stack of (node, parent index) pairs
+                buf = io.StringIO()
+                buf.write('digraph g {\n\tnode [height=.1 shape=record]\n')
+                stack = [(self.tree, None)]
+                while stack:
+                        node, parent_node_index = stack.pop()
+                        node_index = node.index
+                        if node.left is None and node.right is None:
                                 threshold_str = ""
                                 leaf = True
                         else:
-                                threshold_str = "{} <= {:.3f}\\n".format(feature_names[node['j_feature']], node["threshold"])
+                                threshold_str = "{} <= {:.3f}\\n".format(feature_names[node.j_feature], node.threshold)
                                 leaf = False
 
-                        if "lower_loss" in node:
-                                label_str = "node {} \\n {} n_samples = {}\\n loss = {:.6f}\\n lower_loss = {}".format(node_index,threshold_str, node["n_samples"], node["test_loss"], node["lower_loss"])
-                        elif "test_loss" in node:
-                                label_str = "node {} \\n {} n_samples = {}\\n loss = {:.6f}".format(node_index,threshold_str, node["n_samples"], node["test_loss"])
+                        if node.lower_loss is not None:
+                                label_str = "node {} \\n {} n_samples = {}\\n loss = {:.6f}\\n lower_loss = {}".format(node_index,threshold_str, node.n_samples, node.test_loss, node.lower_loss)
+                        elif node.test_loss is not None:
+                                label_str = "node {} \\n {} n_samples = {}\\n loss = {:.6f}".format(node_index,threshold_str, node.n_samples, node.test_loss)
                         else:
-                                label_str = "node {} \\n {} n_samples = {}\\n loss = {:.6f}".format(node_index,threshold_str, node["n_samples"], node["loss"])
+                                label_str = "node {} \\n {} n_samples = {}\\n loss = {:.6f}".format(node_index,threshold_str, node.n_samples, node.loss)
+                        label_str = label_str.replace('"', '\\"')
+
                         # Create node
                         if leaf:
                             nodeshape = "rectangle"
@@ -535,66 +771,41 @@ class PolyTree(object):
                             nodeshape = "rectangle"
                             style     = ["filled"]
                             fillcolor = "#EBFAFF"
-                        if node["flag"]:
+                        if node.flag:
                             style.append('bold')
                         bordercolor = "black"
                         fontcolor = "black"
-                        g.attr('node', label=label_str, shape=nodeshape)
-                        g.node('node{}'.format(node_index),
-                                   color=bordercolor, style=', '.join(style),
-                                   fillcolor=fillcolor, fontcolor=fontcolor)
+                        buf.write('\tnode{} [label="{}" shape={} color={} fillcolor="{}" fontcolor={} style="{}"]\n'.format(
+                                  node_index, label_str, nodeshape, bordercolor, fillcolor, fontcolor, ", ".join(style)))
 
                         # Create edge
-                        if parent_depth > 0:
-                                if node["flag"]:
+                        if parent_node_index is not None:
+                                if node.flag:
                                     edgecolor = 'orange'
                                     style     = 'bold'
                                 else:
                                     edgecolor = 'black'
                                     style     = 'solid'
-                                g.edge('node{}'.format(parent_node_index),
-                                           'node{}'.format(node_index), label=edge_label, color=edgecolor,style=style)
-
-                        # Traverse child or append leaf value
-                        _build_graphviz_recurse(node["children"]["left"],
-                                                                   parent_node_index=node_index,
-                                                                   parent_depth=parent_depth + 1,
-                                                                   edge_label="")
-                        _build_graphviz_recurse(node["children"]["right"],
-                                                                   parent_node_index=node_index,
-                                                                   parent_depth=parent_depth + 1,
-                                                                   edge_label="")
-
-                def _flag_tree_walk(node,X):
-                        node["flag"] = True
-                        if node["children"]["left"] is None and \
-                              node["children"]["right"] is None:
-                                return
-                        if X[node["j_feature"]] <= node["threshold"]:
-                                return _flag_tree_walk(node["children"]["left"],X)
-                        if X[node["j_feature"]] > node["threshold"]:
-                                return _flag_tree_walk(node["children"]["right"],X)
-
-                # Flag the node path to highlight later
-                if X is not None:
-                        _flag_tree_walk(self.tree,X)
+                                buf.write('\tnode{} -> node{} [label="" color={} style={}]\n'.format(parent_node_index, node_index, edgecolor, style))
 
-                # Build graph
-                _build_graphviz_recurse(self.tree,
-                                                           parent_node_index=0,
-                                                           parent_depth=0,
-                                                           edge_label="")
+                        # Traverse children (right pushed first, so the left subtree is written first)
+                        if not leaf:
+                                stack.append((node.right, node_index))
+                                stack.append((node.left, node_index))
+                buf.write('}\n')
+                source = buf.getvalue()
 
                 if file_name is None:
                         try:
-                                g.render(view=True)
+                                from graphviz import Source
+                                Source(source, filename='g.gv').render(view=True)
                         except:
                                 file_name = 'tree.dot'
                                 print("GraphViz source file written to " + file_name + " and can be viewed using an online renderer. Alternatively you can install graphviz on your system to render locally")
 
                 if file_name is not None: # not elif here as file_name might be updated in try-except above
                         with open(file_name, "w") as file:
-                                file.write(str(g.source))
+                                file.write(source)
 
         def get_node(self, X):
                 """
@@ -605,35 +816,27 @@ class PolyTree(object):
                 :param numpy.ndarray or int X:
                         An ndarray with shape (dimensions) containing the input vector for a given sample, or an int containing the node index.
                 :return:
-                **node**: The data for the node X belongs to; output as a dict.
+                **node**: The node X belongs to, with its ``index``, ``poly``, ``loss``, ``n_samples``, split (``j_feature`` and ``threshold``) and children (``left`` and ``right``) as attributes.
                 """
                 # Find node with given index X. Traverse all children until correct node found.
                 if isinstance(X,int):
-                        def _get_node_from_n(node):
-                                if node is not None: # Need to check if node is None here as below _get_node_from_n() calls on children will result in None if leaf node
-                                        if node["index"] == X:
-                                                return node
-                                        else:
-                                                result = _get_node_from_n(node["children"]["right"])
-                                                if result is None:
-                                                        result = _get_node_from_n(node["children"]["left"])
-                                                return result
-                                else:
-                                        return None
-                        return _get_node_from_n(self.tree)
+                        stack = [self.tree]
+                        while stack:
+                                node = stack.pop()
+                                if node.index == X:
+                                        return node
+                                if node.left is not None:
+                                        stack.append(node.left)
+                                        stack.append(node.right)
+                        return None
 
                 # Walk through tree for a given X input vector. Return the final leaf node.
                 else:
                         assert len(X.shape)==1 , "X should be an int, or a 1D float array"
-                        def _get_node_from_X(node):
-                                if node["children"]["left"] is None and \
-                                  node["children"]["right"] is None:
-                                        return node
-                                if X[node["j_feature"]] <= node["threshold"]:
-                                        return _get_node_from_X(node["children"]["left"])
-                                if X[node["j_feature"]] > node["threshold"]:
-                                        return _get_node_from_X(node["children"]["right"])
-                        return _get_node_from_X(self.tree)
+                        node = self.tree
+                        while node.left is not None:
+                                node = node.left if X[node.j_feature] <= node.threshold else node.right
+                        return node
 
         def get_paths(self,X=None):
                 """
@@ -650,36 +853,38 @@ class PolyTree(object):
 
                 def _find_path(node, path, i):
                         """
-                        Private recursive function to find path through a tree for a given leaf node.
+                        Private function to find path through a tree for a given leaf node (by walking back up from the leaf to the root).
                         """
-                        node_index = node["index"]
-                        info = {'node':node_index,'j':node["j_feature"],'thresh':node["threshold"]}
-                        path.append(info)
-                        if node_index == i:
-                                return True
-                        left = False
-                        right = False
-                        if node["children"]["left"] is not None:
-                                left = _find_path(node["children"]["left"], path, i)
-                        if node["children"]["right"] is not None:
-                                right = _find_path(node["children"]["right"], path, i)
-                        if left or right :
-                                return True
-                        path.remove(info)
-                        return False
+                        while node is not None:
+                                path.append({'node':node.index,'j':node.j_feature,'thresh':node.threshold})
+                                node = parents[node.index]
+                        path.reverse()
 
                 # Get training data if needed
                 if X is None:
-                    X = self.tree["data"][0]
+                    X = self.tree.data[0]
 
                 # Get leaf nodes
                 leave_id = self.apply(X)
 
+                # Find every node, and its parent, in one pass over the tree
+                nodes = {}
+                parents = {self.tree.index: None}
+                stack = [self.tree]
+                while stack:
+                        node = stack.pop()
+                        nodes[node.index] = node
+                        if node.left is not None:
+                                parents[node.left.index] = node
+                                parents[node.right.index] = node
+                                stack.append(node.right)
+                                stack.append(node.left)
+
                 # Loop through leaves and find path for each.
                 paths ={}
                 for leaf in np.unique(leave_id):
                         path_leaf = []
-                        _find_path(self.tree, path_leaf, leaf)
+                        _find_path(nodes[leaf], path_leaf, leaf)
 
                         # Set split info to None for leaf node
                         path_leaf[-1]["j"]      = None
@@ -692,13 +897,12 @@ class PolyTree(object):
 
         def get_decision_surface(self,ax,ij,X=None,y=None,max_depth=None,label=True,
                                  predict=False,error=False,**kwargs):
+                from matplotlib.collections import LineCollection
                 if X is None:
-                        X = self.tree["data"][0]
+                        X = self.tree.data[0]
                 if y is None:
-                        y = self.tree["data"][1]
+                        y = self.tree.data[1]
                 Xij = X[:,ij]
-                self.tree["Xmin"] = np.min(Xij,axis=0)
-                self.tree["Xmax"] = np.max(Xij,axis=0)
 
                 assert (not predict or not error), "predict and error can't both be true at once"
                 if error:
@@ -709,74 +913,163 @@ class PolyTree(object):
                 else:
                         plot = ax.scatter(X[:,ij[0]],X[:,ij[1]],c=y,alpha=0.8,**kwargs)
 
-                def _get_boundaries(nodes,final):
-                        # Find leaf nodes
-                        left_children = [node["children"]["left"] for node in nodes]
-                        leaf_nodes = np.array([True if node is None else False for node in left_children])
+                # Bounding boxes of the nodes (numbered as in the flattened tree) in the ij plane, filled in level by level from the root
+                n_nodes = len(self._flat_nodes)
+                is_leaf = self._flat_left == np.arange(n_nodes)
+                Xmin = np.empty((n_nodes, 2))
+                Xmax = np.empty((n_nodes, 2))
+                Xmin[0] = np.min(Xij,axis=0)
+                Xmax[0] = np.max(Xij,axis=0)
+
+                nodes = np.array([0])
+                depth = 0
+                vsegs, hsegs = [], []
+                while len(nodes)>0:
+                        final = depth==max_depth
 
                         # Get splitting info from non-leaf nodes (i.e. split nodes)
-                        split_nodes = nodes[~leaf_nodes]
-                        split_dims = [node["j_feature"] for node in split_nodes]
-                        split_vals = [node["threshold"] for node in split_nodes]
-                        indices    = [node["index"]     for node in split_nodes]
+                        split_nodes = nodes[~is_leaf[nodes]]
+                        split_vals = self._flat_threshold[split_nodes]
+                        split_x = self._flat_feature[split_nodes]==ij[0]
 
-                        # Labelling done before splits, as we only label up to max_depth and then return
+                        # Labelling done before splits, as we only label up to max_depth and then stop
                         if label:
                                 # If final, label all nodes, else only leaf nodes
-                                if final:
-                                        for node in nodes:
-                                                ax.annotate('Node %d'%node["index"],(node["Xmax"][0],node["Xmax"][1]),
-                                                            ha='right',va='top',textcoords='offset points',
-                                                            xytext=(-5, -5))
-                                        #return
-                                else:
-                                        for node in nodes[leaf_nodes]:
-                                                ax.annotate('Node %d'%node["index"],(node["Xmax"][0],node["Xmax"][1]),
-                                                            ha='right',va='top',textcoords='offset points',
-                                                            xytext=(-5, -5))
-
-                        # Plot split lines
-                        for n, node in enumerate(split_nodes):
-                                if split_dims[n]==ij[0]:
-                                        ax.vlines(split_vals[n],node["Xmin"][1],
-                                                   node["Xmax"][1],'k')
-                                else:
-                                        ax.hlines(split_vals[n],node["Xmin"][0],
-                                                   node["Xmax"][0],'k')
-
-                        # Update bounding boxes of child nodes before returning them
-                        for node in split_nodes:
-                                if node["j_feature"]==ij[0]:
-                                        node["children"]["left"]["Xmax"]  = [node["threshold"],node["Xmax"][1]]
-                                        node["children"]["right"]["Xmin"] = [node["threshold"],node["Xmin"][1]]
-                                        node["children"]["left"]["Xmin"]  = node["Xmin"]
-                                        node["children"]["right"]["Xmax"] = node["Xmax"]
-                                else:
-                                        node["children"]["left"]["Xmax"]  = [node["Xmax"][0],node["threshold"]]
-                                        node["children"]["right"]["Xmin"] = [node["Xmin"][0],node["threshold"]]
-                                        node["children"]["left"]["Xmin"]  = node["Xmin"]
-                                        node["children"]["right"]["Xmax"] = node["Xmax"]
+                                for k in (nodes if final else nodes[is_leaf[nodes]]):
+                                        ax.annotate('Node %d'%self._flat_index[k],(Xmax[k,0],Xmax[k,1]),
+                                                    ha='right',va='top',textcoords='offset points',
+                                                    xytext=(-5, -5))
+
+                        # Collect split lines, as ((x0,y0),(x1,y1)) segments, to be drawn once all levels are visited
+                        xs, ys = split_vals[split_x], split_vals[~split_x]
+                        vsegs.append(np.stack([[xs, Xmin[split_nodes[split_x],1]],
+                                               [xs, Xmax[split_nodes[split_x],1]]]).transpose(2,0,1))
+                        hsegs.append(np.stack([[Xmin[split_nodes[~split_x],0], ys],
+                                               [Xmax[split_nodes[~split_x],0], ys]]).transpose(2,0,1))
+                        if final: break
+
+                        # Update bounding boxes of child nodes before moving to them
+                        left_nodes  = self._flat_left[split_nodes]
+                        right_nodes = self._flat_right[split_nodes]
+                        Xmin[left_nodes]  = Xmin[split_nodes]
+                        Xmax[left_nodes]  = Xmax[split_nodes]
+                        Xmin[right_nodes] = Xmin[split_nodes]
+                        Xmax[right_nodes] = Xmax[split_nodes]
+                        split_dim = np.where(split_x, 0, 1)
+                        Xmax[left_nodes, split_dim]  = split_vals
+                        Xmin[right_nodes, split_dim] = split_vals
+
+                        # Child nodes for next level down
+                        nodes = np.concatenate((left_nodes, right_nodes))
+                        depth += 1
 
-                        # Extract child node info for next level down
-                        left_nodes  = [node["children"]["left"]  for node in split_nodes]
-                        right_nodes = [node["children"]["right"] for node in split_nodes]
+                # Plot all the vertical, and all the horizontal, split lines as one collection each
+                for segs in (vsegs, hsegs):
+                        segs = np.concatenate(segs)
+                        if len(segs)>0:
+                                ax.add_collection(LineCollection(segs, colors='k'))
 
-                        child_nodes = np.array(left_nodes + right_nodes)
+                return plot
 
-                        return child_nodes
+        def _find_split_from_std(self, X, y, sorted_idx=None):
+                """
+                Private method to find the optimal split point for a tree node using the model-agnostic standard deviation criterion of [1]. All candidate thresholds, along all dimensions, are evaluated at once using cumulative sums (and sums of squares) of the sorted response data.
 
-                nodes = np.array([self.tree])
-                depth = 0
-                final = False
-                while len(nodes)>0:
-                        if depth==max_depth: final = True
-                        nodes = _get_boundaries(nodes,final)
-                        if final: break
-                        depth += 1
+                :param PolyTree self:
+                    An instance of the PolyTree class.
+                :param numpy.ndarray X:
+                        An ndarray with shape (number_of_observations, dimensions) containing the input data belonging to the tree node.
+                :param numpy.ndarray y:
+                        An ndarray with shape (number_of_observations,) containing the response data belonging to the tree node.
+                :param numpy.ndarray sorted_idx:
+                        An ndarray with shape (number_of_observations, dimensions) containing the indices that sort each dimension of X (optional).
+                :return:
+                **did_split**: True if a split was found, otherwise False; output as a bool.
+                **split_dim**: The dimension in X within which the best split was found; output as an int.
+                **split_val**: The location of the best split; output as a float.
+                """
+                N, D = X.shape
+
+                # Sort each dimension of X, and reorder y accordingly
+                sort = np.argsort(X, axis=0, kind='stable') if sorted_idx is None else sorted_idx
+                Xs = np.take_along_axis(X, sort, axis=0)
+
+                # Cumulative sums of y (shifted by its mean, see ref. [3]), padded so that row k holds the sum of the first k samples
+                yshift = y[sort] - np.mean(y)
+                ysum = np.zeros((N+1, D))
+                y2sum = np.zeros((N+1, D))
+                np.cumsum(yshift, axis=0, out=ysum[1:])
+                np.cumsum(yshift**2, axis=0, out=y2sum[1:])
+
+                # Candidate thresholds, and the number of samples to the left of (or equal to) each one
+                if self.search == 'exhaustive':
+                        # Every unique value of X along each dimension, restricted to those leaving at least `min_samples_leaf` samples on either side
+                        lo = max(self.min_samples_leaf, 1)
+                        hi = min(N - self.min_samples_leaf, N - 1)
+                        if lo > hi:
+                                return False, None, None
+                        thresholds = Xs[lo-1:hi]
+                        N_l = np.broadcast_to(np.arange(lo, hi+1).reshape(-1,1), thresholds.shape)
+                        unique = Xs[lo-1:hi] != Xs[lo:hi+1]
+                elif self.search == 'grid':
+                        samples = min(self.samples, N)
+                        thresholds = np.linspace(np.min(X, axis=0), np.max(X, axis=0), num=samples)
+                        N_l = np.stack([np.searchsorted(Xs[:,j], thresholds[:,j], side='right') for j in range(D)], axis=1)
+                        unique = True
+                elif self.search == 'histogram':
+                        thresholds, N_l, unique = self._get_histogram_thresholds(Xs)
+                else:
+                        raise Exception('Incorrect search type! Must be \'exhaustive\', \'grid\' or \'histogram\'')
+                N_r = N - N_l
+
+                # Only take splits where both children have more than `min_samples_leaf` samples
+                valid = unique & (N_l >= self.min_samples_leaf) & (N_r >= self.min_samples_leaf)
+                if not np.any(valid):
+                        return False, None, None
+                N_l = np.maximum(N_l, 1)
+                N_r = np.maximum(N_r, 1)
+
+                # Standard deviation of the left and right side for all splits
+                ysum_l = np.take_along_axis(ysum, N_l, axis=0)
+                y2sum_l = np.take_along_axis(y2sum, N_l, axis=0)
+                ysum_r = ysum[-1:] - ysum_l
+                y2sum_r = y2sum[-1:] - y2sum_l
+                sigma_l = np.sqrt(np.maximum(y2sum_l/N_l - (ysum_l/N_l)**2, 0))
+                sigma_r = np.sqrt(np.maximum(y2sum_r/N_r - (ysum_r/N_r)**2, 0))
+
+                # Compute the loss for all splits, and take the best one (searching dimension by dimension)
+                loss = np.std(y) - (N_l*sigma_l + N_r*sigma_r) / N
+                loss = np.where(valid, loss, np.inf).T
+                best_dim, best_idx = np.unravel_index(np.argmin(loss), loss.shape)
+
+                return True, best_dim, thresholds[best_idx, best_dim]
+
+        def _get_histogram_thresholds(self, Xs):
+                """
+                Private method to find the candidate thresholds for a ``histogram`` search: the right edges of (up to) ``max_bins`` equal-frequency bins along each dimension.
 
-                return plot
+                :param PolyTree self:
+                    An instance of the PolyTree class.
+                :param numpy.ndarray Xs:
+                        An ndarray with shape (number_of_observations, dimensions) with each dimension sorted.
+                :return:
+                **thresholds**: An ndarray with shape (number_of_thresholds, dimensions) of candidate thresholds, taken from the data.
+                **N_l**: An ndarray with shape (number_of_thresholds, dimensions) of the number of samples less than or equal to each threshold.
+                **unique**: An ndarray with shape (number_of_thresholds, dimensions), False for thresholds equal to the previous one (when bins hold repeated values).
+                """
+                N, D = Xs.shape
+
+                # Bin edges at equally spaced ranks (the last sample of each bin)
+                bins = min(self.max_bins, N)
+                ranks = np.unique(np.linspace(0, N, num=bins+1)[1:-1].astype(int))
+                thresholds = Xs[np.maximum(ranks, 1) - 1]
+                N_l = np.stack([np.searchsorted(Xs[:,j], thresholds[:,j], side='right') for j in range(D)], axis=1)
+                unique = np.ones(thresholds.shape, dtype=bool)
+                unique[1:] = thresholds[1:] != thresholds[:-1]
 
-        def _find_split_from_grad(self,model, X, y):
+                return thresholds, N_l, unique
+
+        def _find_split_from_grad(self,model, X, y, sorted_idx=None):
                 """
                 Private method to find the optimal split point for a tree node based on the training data in that node.
 
@@ -788,6 +1081,8 @@ class PolyTree(object):
                         An ndarray with shape (number_of_observations, dimensions) containing the input data belonging to the tree node.
                 :param numpy.ndarray y:
                         An ndarray with shape (number_of_observations, 1) containing the response data belonging to the tree node.
+                :param numpy.ndarray sorted_idx:
+                        An ndarray with shape (number_of_observations, dimensions) containing the indices that sort each dimension of X (optional).
                 :return:
                 **did_split**: True if a split was found, otherwise False; output as a bool.
                 **split_dim**: The dimension in X within which the best split was found; output as an int.
@@ -796,69 +1091,162 @@ class PolyTree(object):
                 renorm = True
                 N,D = np.shape(X)
 
-                # Gradient of loss wrt model coefficients
-                P = model.get_poly(X).T
-                r = y-model.get_polyfit(X)
+                # Gradient of loss wrt model coefficients (C-contiguous, so that gathering samples reads whole rows)
+                P = self._get_poly(model, X).T
+                r = (y-np.dot(P, model.coefficients.reshape(-1, 1))).astype(self.dtype, copy=False)
+                P = np.ascontiguousarray(P, dtype=self.dtype)
                 g = r*P
 
-                # Sum of gradients
-                gsum = g.sum(axis=0)
+                # Sum of gradients (accumulated in double precision, as it is used to offset every split)
+                gsum = np.add.reduce(g, axis=0, dtype=np.float64)
+
+                # Sort along all of the split dimensions at once
+                split_dims = list(self.split_dims)
+                sort = np.argsort(X[:,split_dims], axis=0, kind='stable').astype(np.int32) if sorted_idx is None else sorted_idx[:,split_dims]
+                Xs   = np.take_along_axis(X[:,split_dims], sort, axis=0)
 
-                # Loop through all dimensions in X
-                split_dim = None
-                split_val = None
-                gain_max  = -np.inf
-                for d in self.split_dims:
-                    # Sort along feature i
-                    sort = np.argsort(X[:,d])
-                    Xd   = X[sort,d]
+                # Candidate splits (number of samples on the left), leaving at least `min_samples_leaf` samples on either side
+                lo = max(self.min_samples_leaf, 1)
+                hi = min(N - self.min_samples_leaf, N - 1)
+                if lo > hi:
+                    return False, None, None
+                splits = np.arange(lo, hi+1)
 
-                    # Find unique values along one column. #TODO - grid search option
-                    _,splits = np.unique(Xd,return_index=True)
-                    splits = splits[1:]
+                # Number of samples on left and right split
+                N_l = splits.reshape(-1,1,1)
+                N_r = N - N_l
 
-                    # Number of samples on left and right split
-                    N_l = splits
-                    N_r = N - N_l
+                # Only split between unique values. #TODO - grid search option
+                valid = Xs[lo-1:hi] != Xs[lo:hi+1]
 
-                    # Only take splits where both children have more than `min_samples_leaf` samples
-                    idx = np.minimum(N_l, N_r) >= self.min_samples_leaf
-                    splits = splits[idx]
-                    N_l    = N_l[idx].reshape(-1,1)
-                    N_r    = N_r[idx].reshape(-1,1)
+                # For a histogram search, also only split at the bin edges of each dimension
+                if self.search == 'histogram':
+                    _, N_edges, _ = self._get_histogram_thresholds(Xs)
+                    is_edge = np.zeros((N+1, len(split_dims)), dtype=bool)
+                    is_edge[N_edges, np.arange(len(split_dims))] = True
+                    valid &= is_edge[lo:hi+1]
 
-                    # If we've run out of candidate spilts, skip
-                    if len(splits) <= 1:
-                        continue
+                # If a dimension has run out of candidate splits (one or fewer), skip it
+                valid &= valid.sum(axis=0) > 1
+                if not np.any(valid):
+                    return False, None, None
+
+                if numba:
+                    # Compiled scan over the samples of each dimension (in parallel over dimensions, unless nodes are split from several threads)
+                    kernel = _find_split_from_grad_numba_serial if self._numba_serial else _find_split_from_grad_numba
+                    gain, best_idx = kernel(g, np.ascontiguousarray(P[:,1:]), np.mean(P[:,1:], axis=0), gsum, sort, valid, lo, renorm)
+                else:
+                    # Only evaluate the candidate splits valid along at least one dimension (e.g. the bin edges of a histogram search)
+                    keep = np.flatnonzero(valid.any(axis=1))
+                    splits, valid = splits[keep], valid[keep]
+                    N_l = splits.reshape(-1,1,1)
+                    N_r = N - N_l
 
-                    # Sums of gradients for left and right
-                    gsum_left  = g[sort,:].cumsum(axis=0)
-                    gsum_left  = gsum_left[splits-1,:]
+                    # Sums of gradients for left and right, for every candidate split, stored dimension by dimension (shape
+                    # [ndim, Nsplit, nparams]). Left sums are accumulated from the segmented sums between consecutive candidates
+                    bounds = np.concatenate(([0], splits[:-1]))
+                    gsum_left = np.empty((len(split_dims), len(splits), g.shape[1]), dtype=g.dtype)
+                    for i in range(len(split_dims)):
+                        np.cumsum(np.add.reduceat(np.take(g, sort[:splits[-1],i], axis=0), bounds, axis=0), axis=0, out=gsum_left[i])
                     gsum_right = gsum - gsum_left
 
-                    # Renorm. gradients to zero mean and unit std
+                    # Compute the Gain (see Eq. (6) in [1]), with the gradients renorm. to zero mean and unit std
                     if renorm:
-                        mu_l, mu_r, sigma_l, sigma_r = self._get_mean_and_sigma(P[:,1:],splits,N_l,N_r,sort)
-                        gsum_left  = self._renormalise( gsum_left, 1/sigma_l, -mu_l/sigma_l)
-                        gsum_right = self._renormalise(gsum_right, 1/sigma_r, -mu_r/sigma_r)
-
-                    # Compute the Gain (see Eq. (6) in [1])
-                    gain = (gsum_left**2).sum(axis=1)/N_l.reshape(-1) + (gsum_right**2).sum(axis=1)/N_r.reshape(-1)
-
-                    # Find best gain and compare with previous best
-                    best_idx = np.argmax(gain)
-                    gain     = gain[best_idx]
-                    if gain > gain_max:
-                        gain_max  = gain
-                        best_split_dim = d
-                        best_split_val = 0.5*(Xd[splits[best_idx] - 1] + Xd[splits[best_idx]])
-
-                # If gain_max stilll == -np.inf, we must have passed through all features w/o finding a split
-                # so return False. Otherwise return True and the spilt details.
-                if gain_max == -np.inf:
-                    return False, None, None
-                else:
-                    return True, best_split_dim, best_split_val
+                        mu_l, mu_r, sigma_l, sigma_r = [a.transpose(1,0,2) for a in self._get_mean_and_sigma(P[:,1:],splits,N_l,N_r,sort)]
+                        gain = self._get_renormalised_gain( gsum_left, 1/sigma_l, -mu_l/sigma_l, splits) + \
+                               self._get_renormalised_gain(gsum_right, 1/sigma_r, -mu_r/sigma_r, N - splits)
+                    else:
+                        gain = np.einsum('ijk,ijk->ij', gsum_left, gsum_left)/splits + np.einsum('ijk,ijk->ij', gsum_right, gsum_right)/(N - splits)
+
+                    # Best gain in each dimension
+                    gain = np.where(valid.T, gain, -np.inf)
+                    best_idx = np.argmax(gain, axis=1)
+                    gain = gain[np.arange(len(split_dims)), best_idx]
+
+                # Find best gain (searching dimension by dimension)
+                best_dim = np.argmax(gain)
+                best_split = splits[best_idx[best_dim]]
+
+                return True, split_dims[best_dim], 0.5*(Xs[best_split - 1, best_dim] + Xs[best_split, best_dim])
+
+        @staticmethod
+        def _get_poly_key(model, X):
+                """
+                Private method returning the key of the polynomial terms of a model evaluated at X in the cache (see _get_poly).
+                """
+                return id(model), X.__array_interface__['data'][0], X.shape, X.strides
+
+        def _get_poly(self, model, X):
+                """
+                Private method to evaluate the polynomial terms of a model at X, taking them from the cache of polynomials
+                fitted during the current tree build if available. Cache entries are used once, and then freed.
+
+                :param PolyTree self:
+                    An instance of the PolyTree class.
+                :param Poly model:
+                    An instance of the Poly class.
+                :param numpy.ndarray X:
+                        An ndarray with shape (number_of_observations, dimensions) at which to evaluate the polynomial terms.
+                :return:
+                **P**: An ndarray with shape (number_of_terms, number_of_observations) containing the polynomial terms.
+                """
+                P = self._poly_cache.pop(self._get_poly_key(model, X), None)
+                if P is None:
+                        P = model.get_poly(X)
+                return P
+
+        @staticmethod
+        def _partition_sort(sorted_idx, mask):
+                """
+                Partitions the indices sorting each dimension of X into those for the subset X[mask], preserving their order (a stable partition).
+                sorted_idx - [N,ndim] array of indices sorting each column of X.
+                mask       - [N] boolean array selecting the subset of X.
+                """
+                N, D = sorted_idx.shape
+                local = np.cumsum(mask, dtype=sorted_idx.dtype) - 1
+                sorted_idx = sorted_idx.T[mask[sorted_idx.T]].reshape(D, -1).T
+                return local[sorted_idx]
+
+        @staticmethod
+        def _get_partition_sse(V,y,splits):
+                """
+                Computes the residual sum of squares of the least-squares fits of y onto the columns of V, when the data
+                is split in two at each of the locations in the splits array. The Gram matrices of the left and
+                right side are accumulated from the sums over the samples between consecutive splits, so no fits are repeated.
+                V - [N,ncard] array of basis functions evaluated at the (sorted) data.
+                y - [N] array of (sorted) response data.
+                splits - [Nsplit] array of split locations (number of samples on the left).
+                """
+                N, card = V.shape
+
+                # Segments of the data between consecutive (unique) splits, the last one running to the end of the data
+                splits, inverse = np.unique(splits, return_inverse=True)
+                bounds = np.concatenate(([0], splits))
+
+                # Gram matrices of each segment, summing the outer products of a block of samples at a time (so that the
+                # [N,ncard,ncard] array of all of them is never stored)
+                G = np.zeros((len(bounds), card, card))
+                block = max(2**17 // card**2, 1)
+                for start in range(0, N, block):
+                        stop = min(start + block, N)
+                        seg = np.searchsorted(bounds, start, side='right') - 1
+                        local = np.concatenate(([start], bounds[(bounds > start) & (bounds < stop)])) - start
+                        G[seg:seg+len(local)] += np.add.reduceat(np.einsum('ij,ik->ijk', V[start:stop], V[start:stop]), local, axis=0)
+
+                # Cumulative Gram matrices, projections and sums of squares for left and right splits
+                G_l = np.cumsum(G, axis=0, out=G)
+                b_l = np.cumsum(np.add.reduceat(V * y.reshape(-1,1), bounds, axis=0), axis=0)
+                yy_l = np.cumsum(np.add.reduceat(y**2, bounds))
+                G_r = G_l[-1] - G_l[:-1]
+                b_r = b_l[-1] - b_l[:-1]
+                yy_r = yy_l[-1] - yy_l[:-1]
+                G_l, b_l, yy_l = G_l[:-1], b_l[:-1], yy_l[:-1]
+
+                # Residual = |y|^2 - b^T G^-1 b for each side (pseudo-inverse guards against rank deficient splits)
+                sse_l = yy_l - np.einsum('ij,ijk,ik->i', b_l, np.linalg.pinv(G_l, hermitian=True), b_l)
+                sse_r = yy_r - np.einsum('ij,ijk,ik->i', b_r, np.linalg.pinv(G_r, hermitian=True), b_r)
+
+                return (np.maximum(sse_l, 0) + np.maximum(sse_r, 0))[inverse]
 
         @staticmethod
         def _get_mean_and_sigma(X,splits,N_l,N_r,sort):
@@ -868,48 +1256,260 @@ class PolyTree(object):
                 its mean to avoid catastrophic cancellation when computing the variance (see ref. [3]).
                 X - [N,ndim] array of data.
                 splits  - [Nsplit] array of split locations.
-                sort   - [N] array reordering X.
+                sort   - [N] array reordering X, or [N,nsort] array of several reorderings (the results then have shape [Nsplit,nsort,ndim]).
                 """
                 # Min value of sigma (for stability later)
                 epsilon = 0.001
         
                 # Reorder, and shift X by mean
                 mu     = np.reshape(np.mean(X, axis=0), (1, -1))
-                Xshift = X[sort] - mu
+                Xshift = np.take(X, sort, axis=0) - mu
         
-                # Cumulative sums (and sums of squares) for left and right splits
-                Xsum_l  = Xshift.cumsum(axis=0)
-                Xsum_r  = Xsum_l[-1:,:] - Xsum_l
-                X2sum_l = (Xshift**2).cumsum(axis=0)
-                X2sum_r = X2sum_l[-1:,:] - X2sum_l
+                # Cumulative sums (and sums of squares) up to each split, for left and right splits
+                Xsum  = Xshift.cumsum(axis=0)
+                X2sum = np.square(Xshift, out=Xshift).cumsum(axis=0)
+                mu_l  = Xsum[splits-1,:]
+                mu_r  = Xsum[-1,:] - mu_l
+                var_l = X2sum[splits-1,:]
+                var_r = X2sum[-1,:] - var_l
         
-                # Compute mean of left and right side for all splits
-                mu_l = Xsum_l[splits-1,:] / N_l
-                mu_r = Xsum_r[splits-1,:] / N_r
+                # Compute mean of left and right side for all splits (in place, as the arrays above are fresh copies)
+                mu_l /= N_l
+                mu_r /= N_r
         
                 # Compute standard deviation of left and right side for all splits
-                sigma_l = np.sqrt(np.maximum(X2sum_l[splits-1,:]/(N_l-1)-mu_l**2, epsilon**2))
-                sigma_r = np.sqrt(np.maximum(X2sum_r[splits-1,:]/(N_r-1)-mu_r**2, epsilon**2))
+                for var, mu_s, N_s in ((var_l, mu_l, N_l), (var_r, mu_r, N_r)):
+                        var /= N_s-1
+                        var -= mu_s*mu_s
+                        np.maximum(var, epsilon**2, out=var)
+                        np.sqrt(var, out=var)
+                sigma_l, sigma_r = var_l, var_r
         
                 # Correct for previous shift
-                mu_l = mu_l + mu
-                mu_r = mu_r + mu
+                mu_l += mu
+                mu_r += mu
         
                 return mu_l, mu_r, sigma_l, sigma_r
         
         @staticmethod
-        def _renormalise(gradients, a, c):
+        def _get_renormalised_gain(gradients, a, c, N):
                 """
-                Renormalises gradients according to according to eq. (14) of [1].
+                Computes the gain (see Eq. (6) in [1]) of gradients renormalised according to eq. (14) of [1], without
+                storing the renormalised gradients.
                 Inputs
                 ------
-                gradients: array [n_samples, n_params] of gradients
-                a: array [n_samples, n_params-1]: The normalisation factor
-                c: array [n_samples, n_params-1]: The normalisation offset
+                gradients: array [..., n_params] of gradients
+                a: array [..., n_params-1]: The normalisation factor
+                c: array [..., n_params-1]: The normalisation offset (overwritten)
+                N: array [...]: The number of samples
                 Returns
                 -------
-                gradients: array [n_samples, n_params]: Renormalised gradients
+                gain: array [...]: Sum of squared renormalised gradients, divided by N
                 """
-                c = c*gradients[:,0].reshape(-1,1)
-                gradients[:,1:] = gradients[:,1:] * a + c
-                return gradients
+                c *= gradients[...,0:1]
+                c += gradients[...,1:] * a
+                return (gradients[...,0]**2 + np.einsum('...k,...k->...', c, c)) / N
+
+def _get_smoothing_mask(n, deepest):
+    """
+    Returns a boolean array marking the node predictions used when smoothing the tree predictions (see _smooth).
+    n - [N,ndepth] array of the number of training samples in the node reached at each depth.
+    deepest - [N] array of the depth of the leaf node reached.
+    """
+    rows = np.arange(n.shape[0])
+    needed = np.zeros(n.shape, dtype=bool)
+    needed[rows, deepest] = True
+    active = deepest > 0
+    for i in range(n.shape[1] - 1, 0, -1):
+        smooth = active & (deepest >= i)
+        active &= ~(smooth & (n[:, i] == 0))
+        needed[:, i] |= smooth & active
+    return needed
+
+def _traverse_tree_numpy(feature, threshold, left, right, X, n_levels):
+    """
+    Walks the observations in X down a flattened tree (see PolyTree._flatten_tree), returning the node reached at each depth.
+    feature, threshold, left, right - [nnodes] arrays describing the split at each node.
+    X - [N,ndim] array of observations.
+    n_levels - number of levels to walk down (nodes are repeated once a leaf has been reached).
+    """
+    rows = np.arange(X.shape[0])
+    path = np.zeros((X.shape[0], n_levels), dtype=int)
+    inode = np.zeros(X.shape[0], dtype=int)
+    for depth in range(n_levels):
+        path[:, depth] = inode
+        go_left = X[rows, feature[inode]] <= threshold[inode]
+        inode = np.where(go_left, left[inode], right[inode])
+
+        # Stop early once every observation has reached a leaf
+        if np.all(left[inode] == inode):
+            path[:, depth+1:] = inode.reshape(-1,1)
+            break
+    return path
+
+def _apply_tree_numpy(feature, threshold, left, right, X):
+    """
+    Walks the observations in X down a flattened tree (see PolyTree._flatten_tree), returning the leaf node reached.
+    Observations drop out of the walk as soon as they reach a leaf.
+    feature, threshold, left, right - [nnodes] arrays describing the split at each node.
+    X - [N,ndim] array of observations.
+    """
+    inode = np.zeros(X.shape[0], dtype=int)
+    active = np.flatnonzero(left[inode] != inode)
+    while len(active) > 0:
+        k = inode[active]
+        go_left = X[active, feature[k]] <= threshold[k]
+        k = np.where(go_left, left[k], right[k])
+        inode[active] = k
+        active = active[left[k] != k]
+    return inode
+
+def _smooth_numpy(pred, n, deepest, k):
+    """
+    Smooths the tree predictions, starting from the deepest node reached by each observation and moving back up
+    towards the root until a node with no samples is reached.
+    pred - [N,ndepth] array of the prediction of the node reached at each depth.
+    n - [N,ndepth] array of the number of training samples in the node reached at each depth.
+    deepest - [N] array of the depth of the leaf node reached.
+    k - smoothing constant.
+    """
+    smoothed = pred[np.arange(pred.shape[0]), deepest]
+    active = deepest > 0
+    for i in range(pred.shape[1] - 1, 0, -1):
+        smooth = active & (deepest >= i)
+        active &= ~(smooth & (n[:, i] == 0))
+        smooth &= active
+        smoothed = np.where(smooth, (smoothed * n[:, i] + pred[:, i] * k) / (k + n[:, i]), smoothed)
+    return smoothed
+
+if numba:
+    @njit(parallel=True, cache=True)
+    def _traverse_tree_numba(feature, threshold, left, right, X, n_levels):
+        path = np.empty((X.shape[0], n_levels), dtype=np.int64)
+        for j in prange(X.shape[0]):
+            inode = 0
+            for depth in range(n_levels):
+                path[j, depth] = inode
+                if X[j, feature[inode]] <= threshold[inode]:
+                    inode = left[inode]
+                else:
+                    inode = right[inode]
+        return path
+
+    @njit(parallel=True, cache=True)
+    def _apply_tree_numba(feature, threshold, left, right, X):
+        leaves = np.empty(X.shape[0], dtype=np.int64)
+        for j in prange(X.shape[0]):
+            inode = 0
+            while left[inode] != inode:
+                if X[j, feature[inode]] <= threshold[inode]:
+                    inode = left[inode]
+                else:
+                    inode = right[inode]
+            leaves[j] = inode
+        return leaves
+
+    @njit(parallel=True, cache=True)
+    def _smooth_numba(pred, n, deepest, k):
+        smoothed = np.empty(pred.shape[0])
+        for j in prange(pred.shape[0]):
+            i = deepest[j]
+            smoothed_j = pred[j, i]
+            while i > 0:
+                if n[j, i] == 0:
+                    break
+                smoothed_j = (smoothed_j * n[j, i] + pred[j, i] * k) / (k + n[j, i])
+                i -= 1
+            smoothed[j] = smoothed_j
+        return smoothed
+
+    def _find_split_from_grad_kernel(g, P, mu, gsum, sort, valid, lo, renorm):
+        """
+        Finds the best gradient based split along each dimension (see PolyTree._find_split_from_grad) in a single pass over the
+        sorted samples, accumulating the sums of gradients (and the mean and variance of P, see PolyTree._get_mean_and_sigma).
+        g - [N,nparams] array of gradients.
+        P - [N,nparams-1] array of the (non-constant) polynomial terms.
+        mu - [nparams-1] array of the mean of P.
+        gsum - [nparams] array of the sum of gradients.
+        sort - [N,ndim] array of indices sorting each dimension.
+        valid - [Nsplit,ndim] array marking valid splits, with split i leaving lo+i samples on the left.
+        lo - smallest number of samples on the left.
+        renorm - renormalise the gradients.
+        Returns the best gain, and the index of the best split, in each dimension.
+        """
+        epsilon = 0.001
+        N, K = g.shape
+        Nsplit, D = valid.shape
+        best_gain = np.full(D, -np.inf)
+        best_idx = np.zeros(D, dtype=np.int64)
+        for d in prange(D):
+            # Totals of P (shifted by its mean) and its squares, summed in sorted order
+            P_tot = np.zeros(K-1)
+            P2_tot = np.zeros(K-1)
+            for i in range(N):
+                for k in range(K-1):
+                    shift = P[sort[i, d], k] - mu[k]
+                    P_tot[k] += shift
+                    P2_tot[k] += shift**2
+
+            gsum_l = np.zeros(K)
+            P_l = np.zeros(K-1)
+            P2_l = np.zeros(K-1)
+            for i in range(lo + Nsplit - 1):
+                j = sort[i, d]
+                for k in range(K):
+                    gsum_l[k] += g[j, k]
+                for k in range(K-1):
+                    shift = P[j, k] - mu[k]
+                    P_l[k] += shift
+                    P2_l[k] += shift**2
+
+                N_l = i + 1
+                if N_l < lo or not valid[N_l - lo, d]:
+                    continue
+                N_r = N - N_l
+
+                # Gain of the split (see Eq. (6) in [1]), with the gradients renormalised to zero mean and unit std
+                gain = gsum_l[0]**2/N_l + (gsum[0] - gsum_l[0])**2/N_r
+                for k in range(1, K):
+                    gsum_lk = gsum_l[k]
+                    gsum_rk = gsum[k] - gsum_l[k]
+                    if renorm:
+                        mu_l = P_l[k-1] / N_l
+                        mu_r = (P_tot[k-1] - P_l[k-1]) / N_r
+                        sigma_l = np.sqrt(max(P2_l[k-1]/(N_l-1) - mu_l**2, epsilon**2))
+                        sigma_r = np.sqrt(max((P2_tot[k-1] - P2_l[k-1])/(N_r-1) - mu_r**2, epsilon**2))
+                        mu_l = mu_l + mu[k-1]
+                        mu_r = mu_r + mu[k-1]
+                        gsum_lk = gsum_lk * (1/sigma_l) + (-mu_l/sigma_l) * gsum_l[0]
+                        gsum_rk = gsum_rk * (1/sigma_r) + (-mu_r/sigma_r) * (gsum[0] - gsum_l[0])
+                    gain += gsum_lk**2/N_l + gsum_rk**2/N_r
+
+                if gain > best_gain[d]:
+                    best_gain[d] = gain
+                    best_idx[d] = N_l - lo
+        return best_gain, best_idx
+
+    # Numba's workqueue threading layer can't run parallel kernels from several threads at once (e.g. when subtrees are
+    # split in parallel), so a serial version of the kernel is compiled too. It is not cached, as Numba's cache doesn't
+    # tell apart two compilations of the same function
+    _find_split_from_grad_numba = njit(parallel=True, cache=True, error_model='numpy')(_find_split_from_grad_kernel)
+    _find_split_from_grad_numba_serial = njit(error_model='numpy')(_find_split_from_grad_kernel)
+
+    def _is_workqueue():
+        """
+        Returns True if Numba runs its parallel kernels with the (not thread-safe) workqueue threading layer.
+        """
+        try:
+            return threading_layer() == 'workqueue'
+        except ValueError:
+            # The threading layer is only chosen when the first parallel kernel is run
+            return config.THREADING_LAYER == 'workqueue'
+
+    _traverse_tree = _traverse_tree_numba
+    _apply_tree = _apply_tree_numba
+    _smooth = _smooth_numba
+else:
+    _traverse_tree = _traverse_tree_numpy
+    _apply_tree = _apply_tree_numpy
+    _smooth = _smooth_numpy
@@ -30,6 +30,7 @@ setup(name='equadratures',
       ],
       extras_require={
           "cvxpy":  ['cvxpy>=1.1'],
+          "numba":  ['numba'],
           },
       test_suite='nose.collector',
       tests_require=['nose'],
@@ -3,6 +3,16 @@ import unittest
 from equadratures import *
 import numpy as np
 import scipy.stats as st
+import os
+import re
+import tempfile
+from unittest import mock
+
+try:
+    import numba
+    has_numba = True
+except ImportError:
+    has_numba = False
 
 def unison_shuffled_copies(a, b):
     assert len(a) == len(b)
@@ -112,5 +122,148 @@ class Test_polytree(TestCase):
 
         self.assertTrue(r_value ** 2 > 0.95)
 
+    def test_parallel_split_search(self):
+        X = []
+        y = []
+        for x1 in range(0, 10):
+            for x2 in range(0, 10):
+                X.append(np.array([x1/10,x2/10]))
+                y.append(np.exp(-(x1/10)**2 + (x2/10)**2))
+        X = np.array(X)
+        y = np.array(y)
+
+        for incremental in [True, False]:
+            serial_tree = polytree.PolyTree(max_depth=2, incremental=incremental)
+            serial_tree.fit(X, y)
+
+            for n_jobs in [2, 4]:
+                parallel_tree = polytree.PolyTree(max_depth=2, incremental=incremental, n_jobs=n_jobs)
+                parallel_tree.fit(X, y)
+
+                self.assertEqual(serial_tree.get_splits(), parallel_tree.get_splits())
+                np.testing.assert_array_equal(serial_tree.apply(X), parallel_tree.apply(X))
+                np.testing.assert_allclose(serial_tree.predict(X), parallel_tree.predict(X))
+
+    def test_parallel_gradient_criterion(self):
+        X = np.random.uniform(-1, 1, size=(500, 3))
+        y = np.sin(3*X[:,0]) + X[:,1]**2 + np.abs(X[:,2])
+
+        # Sibling subtrees are split from several threads at once (with serial compiled split searches if numba is installed)
+        serial_tree = polytree.PolyTree(splitting_criterion='loss_gradient', max_depth=4)
+        serial_tree.fit(X, y)
+
+        for n_jobs in [2, 8]:
+            parallel_tree = polytree.PolyTree(splitting_criterion='loss_gradient', max_depth=4, n_jobs=n_jobs)
+            parallel_tree.fit(X, y)
+
+            self.assertEqual(serial_tree.get_splits(), parallel_tree.get_splits())
+            np.testing.assert_allclose(serial_tree.predict(X), parallel_tree.predict(X))
+
+    @unittest.skipUnless(has_numba, "numba is not installed")
+    def test_numba_kernels(self):
+        X = np.random.uniform(-1, 1, size=(500, 3))
+        y = np.sin(3*X[:,0]) + X[:,1]**2 + np.abs(X[:,2])
+
+        tree = polytree.PolyTree(splitting_criterion='loss_gradient', max_depth=4)
+        tree.fit(X, y)
+
+        # The gradient split search finds the same splits without numba
+        with mock.patch.object(polytree, 'numba', False):
+            numpy_tree = polytree.PolyTree(splitting_criterion='loss_gradient', max_depth=4)
+            numpy_tree.fit(X, y)
+        self.assertEqual(tree.get_splits(), numpy_tree.get_splits())
+
+        # The tree walks, and the smoothing, match their numpy versions on the flattened tree
+        flat = (tree._flat_feature, tree._flat_threshold, tree._flat_left, tree._flat_right)
+        path = polytree._traverse_tree_numba(*flat, X, tree.actual_max_depth + 2)
+        np.testing.assert_array_equal(path, polytree._traverse_tree_numpy(*flat, X, tree.actual_max_depth + 2))
+        np.testing.assert_array_equal(polytree._apply_tree_numba(*flat, X), polytree._apply_tree_numpy(*flat, X))
+
+        # Smooth random predictions along the paths (with some nodes holding no samples, which stop the smoothing)
+        pred = np.random.normal(size=path.shape)
+        n = tree._flat_n_samples[path].astype(float)
+        n[np.random.uniform(size=n.shape) < 0.2] = 0
+        deepest = tree._flat_depth[path[:, -1]]
+        np.testing.assert_allclose(polytree._smooth_numba(pred, n, deepest, tree.k), polytree._smooth_numpy(pred, n, deepest, tree.k))
+
+    def test_veb_layout(self):
+        X = np.random.uniform(-1, 1, size=(400, 2))
+        y = np.sin(3*X[:,0]) + X[:,1]**2 + 0.3*np.random.normal(size=400)
+        X_train, X_test = X[:300], X[300:]
+        y_train, y_test = y[:300], y[300:]
+
+        bfs_tree = polytree.PolyTree(max_depth=4, layout='bfs')
+        bfs_tree.fit(X_train, y_train)
+        veb_tree = polytree.PolyTree(max_depth=4, layout='veb')
+        veb_tree.fit(X_train, y_train)
+
+        # The node layout only changes how the tree is stored, before and after pruning
+        for prune in [False, True]:
+            if prune:
+                n_leaves = len(bfs_tree.get_polys())
+                bfs_tree.prune(X_test, y_test)
+                veb_tree.prune(X_test, y_test)
+                self.assertLess(len(bfs_tree.get_polys()), n_leaves)
+            np.testing.assert_array_equal(bfs_tree.apply(X), veb_tree.apply(X))
+            np.testing.assert_allclose(bfs_tree.predict(X), veb_tree.predict(X))
+
+    def test_gradient_dtype(self):
+        X = np.random.uniform(-1, 1, size=(500, 3))
+        y = np.sin(3*X[:,0]) + X[:,1]**2 + np.abs(X[:,2])
+
+        # Single precision gradients find the same splits as double precision ones
+        tree64 = polytree.PolyTree(splitting_criterion='loss_gradient', max_depth=3)
+        tree64.fit(X, y)
+        tree32 = polytree.PolyTree(splitting_criterion='loss_gradient', max_depth=3, dtype=np.float32)
+        tree32.fit(X, y)
+        self.assertEqual(tree64.get_splits(), tree32.get_splits())
+
+        for dtype in [np.float16, np.int32]:
+            with self.assertRaises(AssertionError):
+                polytree.PolyTree(splitting_criterion='loss_gradient', dtype=dtype)
+
+    def test_graphviz_paths(self):
+        X = np.random.uniform(0, 1, size=(200, 2))
+        y = X[:,0]**2 + (X[:,1] > 0.5)
+
+        tree = polytree.PolyTree(max_depth=3)
+        tree.fit(X, y)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_name = os.path.join(tmpdir, 'tree.dot')
+
+            # Highlight the paths of several samples, and then of one sample (clearing the earlier highlights)
+            for X_flag in [X[:5], X[5:6]]:
+                tree.get_graphviz(X=X_flag, file_name=file_name)
+                with open(file_name) as f:
+                    source = f.read()
+
+                bold_nodes = {int(i) for i in re.findall(r'\tnode(\d+) \[[^\n]*style="[^"\n]*bold"', source)}
+                orange_edges = {(int(i), int(j)) for i, j in re.findall(r'node(\d+) -> node(\d+) [^\n]*color=orange', source)}
+
+                paths = tree.get_paths(X_flag)
+                self.assertEqual(set(paths.keys()), set(tree.apply(X_flag)))
+                self.assertEqual(bold_nodes, {step['node'] for path in paths.values() for step in path})
+                self.assertEqual(orange_edges, {(path[i]['node'], path[i+1]['node']) for path in paths.values() for i in range(len(path)-1)})
+
+    def test_histogram_search(self):
+        X = np.random.uniform(0, 1, size=(200, 2))
+        y = X[:,0]**2 + (X[:,1] > 0.5)
+
+        # With at least as many bins as samples, the histogram search sees every split of the exhaustive search
+        for splitting_criterion in ['model_aware', 'model_agnostic', 'loss_gradient']:
+            exhaustive_tree = polytree.PolyTree(splitting_criterion, max_depth=2)
+            exhaustive_tree.fit(X, y)
+
+            histogram_tree = polytree.PolyTree(splitting_criterion, max_depth=2, search='histogram', max_bins=200)
+            histogram_tree.fit(X, y)
+
+            self.assertEqual(exhaustive_tree.get_splits(), histogram_tree.get_splits())
+
+        tree = polytree.PolyTree(max_depth=2, search='histogram', max_bins=8)
+        tree.fit(X, y)
+        _, _, r_value, _, _ = st.linregress(y, tree.predict(X).reshape(-1))
+        self.assertTrue(r_value ** 2 > 0.9)
+
 if __name__== '__main__':
     unittest.main()